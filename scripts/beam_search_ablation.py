@@ -27,80 +27,87 @@ from seq_queries.arguments import get_args, print_args
 from seq_queries.train import load_checkpoint
 from seq_queries.utils import write_pkl
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, beam_search_is_hybrid
-from seq_queries.experiments import sample_dynamic_target_token, prep_experiment, beam_search_ablation
+from seq_queries.experiments import sample_dynamic_target_token, prep_experiment, beam_search_batched
+from seq_queries.experiments import prep_experiment_cached, run_sweep, limit_queries, set_inference_backends, experiment_out_dir
+from seq_queries.experiments import sweep_work_items, make_out_dirs
 
 #################################################################################
 #   Function-Class Declaration
 #################################################################################
 
-device=3
+devices=None # All visible GPUs
 folders = ["beam_search_ablation"]
 datasets = ['shakespeare','moocs']#'shakespeare'
 max_num_queries=100
 config_path = "config/sample.yaml"
+amp_dtype = None # Full precision, set 'bf16' or 'fp16' to autocast forward passes
 covs =[0.95,0.75,0.5]
 lengths_coverage = {
-    # Long GT
-    "moocs":[(5,15,h) for h in covs],
-    "amazon":[(5,15,h) for h in covs],
-    "apps":[(5,15,h) for h in covs],
-    "shakespeare": [(5,15,h) for h in covs],
+    "moocs":[(5,15,0.95),(5,15,0.75),(5,15,0.5)],
+    "amazon":[(5,15,0.95),(5,15,0.75),(5,15,0.5)],
+    "apps":[(5,15,0.95),(5,15,0.75),(5,15,0.5)],
+    "shakespeare": [(5,15,0.95),(5,15,0.75),(5,15,0.5)],
 }
+# Every dataset sweeps exactly the coverages in covs
+for dataset_name, cells in lengths_coverage.items():
+    assert {h for _,_,h in cells} == set(covs),\
+        f"Dataset {dataset_name} sweeps {sorted({h for _,_,h in cells})}, expected {sorted(covs)}"
 
-for dataset_name in datasets:
-    len_info = lengths_coverage[dataset_name]
-    print("====="*10)
-    print(f"* Running for dataset {dataset_name}")
-    print("====="*10)
-    extra_args = {"max_num_queries":max_num_queries}
-    prep_dict = prep_experiment(config_path,
-                                dataset_name,
-                                device=device,
-                                extra_args=extra_args)
-    prep_dict['args'].text_dict['text'] = None
-    args = prep_dict['args']
-    val_dl = prep_dict['val_dl']
+set_inference_backends()
+
+def _run_cell(device, dataset_name, folder, hist_len, total_seq_len, coverages):
+    extra_args = {"max_num_queries":max_num_queries, "amp_dtype":amp_dtype}
+    prep_dict = prep_experiment_cached(config_path,
+                                       dataset_name,
+                                       device=device,
+                                       extra_args=extra_args)
+    if ('prefixes', max_num_queries) not in prep_dict:
+        # All queries of the dataset are searched together, prefixes are kept
+        # on device and reused for every configuration
+        prep_dict[('prefixes', max_num_queries)] = torch.cat(
+            limit_queries(prep_dict['val_dl'], max_num_queries)).to(device)
+    prefixes = prep_dict[('prefixes', max_num_queries)]
     model = prep_dict['model']
-    text_dict = args.text_dict
-    args.text_dict = None
-    print_args(vars(args))
-    args.text_dict = text_dict
+
+    args = copy.copy(prep_dict['args']) # text is cleared on prep, shallow copy is enough
+    args.max_num_queries = max_num_queries
+    args.num_mc_samples = 1000 # For reading from hybrid correctly
+    args.estimate_type = beam_search_lower_bound
+    args.bs_ablation=True
+    args.bs_ablation_max_beams=50000
+    args.proposal_func = lm_proposal
+    args.use_gpt2 = (dataset_name == 'wikitext')
+    args.store_intermediate_lbs=False
+    args.batch_size =512
+    args.max_active_beams = args.batch_size # Queries are admitted as finished ones free their rows
+    args.min_variance = False
+    args.hist_len = hist_len
+    args.total_seq_len = total_seq_len
+    coverages = [float(coverage) for coverage in coverages]
+
+    print("[{}] | Dataset: {} | Sample type: {} | Num Beams: {} | Hist length {} | Total Seq Length {}"\
+          .format(datetime.now(), dataset_name,folder,coverages,args.hist_len,args.total_seq_len))
+    # All coverages are searched in the same batched run
+    with torch.inference_mode():
+        coverage_estimates = beam_search_batched(args, prefixes, model, coverages=coverages)
+
+    for coverage, estimates in coverage_estimates.items():
+        estimates['metadata']['text_dict']['text'] = None
+        estimates['metadata']['amp_dtype'] = amp_dtype
+        args.num_beams = coverage
+
+        write_pkl(estimates, experiment_out_dir(folder, dataset_name) /
+        (f"val-dl_{dataset_name}_{folder.replace('_','-')}_" +
+        f"{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
+        f"{'_' + 'model-budget' if False else f'_{args.num_beams}b'}" +
+        f"{f'_{max_num_queries}q' if max_num_queries else ''}" +
+        f"{f'_{amp_dtype}' if amp_dtype else ''}.pkl"))
+
     print("====="*10)
 
-    for folder in folders:
-        for hist_len,total_seq_len,coverage in len_info:
-            args = copy.deepcopy(prep_dict['args'])
-            args.num_mc_samples = 1000 # For reading from hybrid correctly
-            args.estimate_type = beam_search_lower_bound
-            args.bs_ablation=True
-            args.bs_ablation_max_beams=50000
-            args.proposal_func = lm_proposal
-            args.use_gpt2 = (dataset_name == 'wikitext')
-            args.store_intermediate_lbs=False
-            args.batch_size =512
-            args.min_variance = False
-            args.hist_len = hist_len
-            args.total_seq_len = total_seq_len
-            args.num_beams = float(coverage)
-
-            print("[{}] | Dataset: {} | Sample type: {} | Num Beams: {} | Hist length {} | Total Seq Length {}"\
-                  .format(datetime.now(), dataset_name,folder,args.num_beams,args.hist_len,args.total_seq_len))
-            estimates = beam_search_ablation(args, val_dl, model)
-            os.makedirs(f"data/{folder}/{dataset_name}/val_dl/",exist_ok=True)
-            estimates['metadata']['text_dict']['text'] = None
-            args.num_beams = float(coverage)
-
-            # for e,d in estimates.items():
-            #     if isinstance(d, list):
-            #         print(e, len(d))
-            #         for item in d:
-            #             print(len(item))
-            # sys.exit(1)
-
-            write_pkl(estimates,
-            f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_" +
-            f"{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
-            f"{'_' + 'model-budget' if False else f'_{args.num_beams}b'}" +
-            f"{f'_{max_num_queries}q' if max_num_queries else ''}.pkl")
-
-            print("====="*10)
+# Coverages of the same lengths are grouped into one cell
+work_items = sweep_work_items(datasets, folders, lengths_coverage, group_last=True)
+
+if __name__ == "__main__":
+    make_out_dirs(work_items)
+    run_sweep(_run_cell, work_items, devices=devices)
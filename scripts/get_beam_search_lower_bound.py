@@ -28,12 +28,14 @@ from seq_queries.train import load_checkpoint
 from seq_queries.utils import write_pkl
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate, beam_search_is_hybrid
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment
+from seq_queries.experiments import prep_experiment_cached, run_sweep, limit_queries, set_inference_backends, experiment_out_dir
+from seq_queries.experiments import sweep_work_items, make_out_dirs
 
 #################################################################################
 #   Function-Class Declaration
 #################################################################################
 
-device=0
+devices=None # All visible GPUs
 folders = ["beam_search"]
 datasets = ['shakespeare','moocs','apps', 'amazon']
 num_mc_samples = 10000
@@ -42,6 +44,7 @@ num_beams = 0.8
 model_budget = False
 max_num_queries=1000
 config_path = "config/sample.yaml"
+amp_dtype = None # Full precision, set 'bf16' or 'fp16' to autocast forward passes
 lengths_coverage = {
 
     # Beam search gt
@@ -51,70 +54,65 @@ lengths_coverage = {
     "shakespeare":[(11,15,0.9)],
 }
 
-for dataset_name in datasets:
-    len_info = lengths_coverage[dataset_name]
-    print("====="*10)
-    print(f"* Running for dataset {dataset_name}")
-    print("====="*10)
-    extra_args = {"max_num_queries":max_num_queries}
-    prep_dict = prep_experiment(config_path,
-                                dataset_name,
-                                device=device,
-                                extra_args=extra_args)
-    prep_dict['args'].text_dict['text'] = None
-    args = prep_dict['args']
-    val_dl = prep_dict['val_dl']
+set_inference_backends()
+
+def _run_cell(device, dataset_name, folder, hist_len, total_seq_len, coverage):
+    extra_args = {"max_num_queries":max_num_queries, "amp_dtype":amp_dtype}
+    prep_dict = prep_experiment_cached(config_path,
+                                       dataset_name,
+                                       device=device,
+                                       extra_args=extra_args)
+    if ('val_batches', max_num_queries) not in prep_dict:
+        # Batches are collated once and reused for every configuration
+        prep_dict[('val_batches', max_num_queries)] = limit_queries(prep_dict['val_dl'], max_num_queries)
+    val_dl = prep_dict[('val_batches', max_num_queries)]
     model = prep_dict['model']
-    text_dict = args.text_dict
-    args.text_dict = None
-    print_args(vars(args))
-    args.text_dict = text_dict
-    print("====="*10)
 
-    for folder in folders:
-        for hist_len,total_seq_len,coverage in len_info:
-            args = copy.deepcopy(prep_dict['args'])
-            args.num_mc_samples = num_mc_samples
-            args.estimate_type = beam_search_lower_bound
-            args.proposal_func = lm_proposal
-            args.use_gpt2 = (dataset_name == 'wikitext')
-            args.store_intermediate_lbs=True
-            args.min_variance = False
-            args.hist_len = hist_len
-            args.total_seq_len = total_seq_len
-            args.num_beams = coverage
-
-            if model_budget:
-                args.model_budget_filepath = (f"{ROOT}" +
-                                            f"data/beam_search_is_hybrid/{dataset_name}/val_dl/val-dl_" +
-                    f"{dataset_name}_beam-search-is-hybrid_{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
-                    f"{f'_{max_num_queries}q' if max_num_queries else ''}.pkl")
-                try:
-                    assert os.path.exists(args.model_budget_filepath),\
-                        f"Model budget filepath {args.model_budget_filepath} does not exist"
-                    print(args.model_budget_filepath)
-                except Exception as e:
-                    print(args.model_budget_filepath)
-                    print(e)
-                    print("====="*10)
-                    continue
-
-            print("[{}] | Dataset: {} | Sample type: {} | Num Beams: {} | Hist length {} | Total Seq Length {}"\
-                  .format(datetime.now(), dataset_name,folder,args.num_beams,args.hist_len,args.total_seq_len))
-            estimates = sample_dynamic_target_token(args, val_dl, model)
-            os.makedirs(f"data/{folder}/{dataset_name}/val_dl/",exist_ok=True)
-            estimates['metadata']['text_dict']['text'] = None
-            args.num_beams = float(coverage)
-
-            # for e,d in estimates.items():
-            #     if isinstance(d, (torch.Tensor, torch.LongTensor)):
-            #         print(e, d.shape)
-            # sys.exit(1)
-
-
-            write_pkl(estimates,
-            f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_" +
-            f"{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
-            f"{'_' + 'model-budget' if model_budget else f'_{args.num_beams}b'}" +
+    args = copy.copy(prep_dict['args']) # text is cleared on prep, shallow copy is enough
+    args.max_num_queries = max_num_queries
+    args.num_mc_samples = num_mc_samples
+    args.estimate_type = beam_search_lower_bound
+    args.proposal_func = lm_proposal
+    args.use_gpt2 = (dataset_name == 'wikitext')
+    args.store_intermediate_lbs=True
+    args.min_variance = False
+    args.hist_len = hist_len
+    args.total_seq_len = total_seq_len
+    args.num_beams = coverage
+
+    if model_budget:
+        args.model_budget_filepath = (f"{ROOT}" +
+                                    f"data/beam_search_is_hybrid/{dataset_name}/val_dl/val-dl_" +
+            f"{dataset_name}_beam-search-is-hybrid_{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
             f"{f'_{max_num_queries}q' if max_num_queries else ''}.pkl")
+        try:
+            assert os.path.exists(args.model_budget_filepath),\
+                f"Model budget filepath {args.model_budget_filepath} does not exist"
+            print(args.model_budget_filepath)
+        except Exception as e:
+            print(args.model_budget_filepath)
+            print(e)
             print("====="*10)
+            return
+
+    print("[{}] | Dataset: {} | Sample type: {} | Num Beams: {} | Hist length {} | Total Seq Length {}"\
+          .format(datetime.now(), dataset_name,folder,args.num_beams,args.hist_len,args.total_seq_len))
+    with torch.inference_mode():
+        estimates = sample_dynamic_target_token(args, val_dl, model)
+    estimates['metadata']['text_dict']['text'] = None
+    estimates['metadata']['amp_dtype'] = amp_dtype
+    args.num_beams = float(coverage)
+
+    write_pkl(estimates, experiment_out_dir(folder, dataset_name) /
+    (f"val-dl_{dataset_name}_{folder.replace('_','-')}_" +
+    f"{args.hist_len}h_{args.total_seq_len}s_{args.num_mc_samples}mc" +
+    f"{'_' + 'model-budget' if model_budget else f'_{args.num_beams}b'}" +
+    f"{f'_{max_num_queries}q' if max_num_queries else ''}" +
+    f"{f'_{amp_dtype}' if amp_dtype else ''}.pkl"))
+    print("====="*10)
+
+work_items = sweep_work_items(datasets, folders, lengths_coverage)
+
+if __name__ == "__main__":
+    make_out_dirs(work_items)
+    run_sweep(_run_cell, work_items, devices=devices)
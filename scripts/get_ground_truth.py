@@ -29,12 +29,14 @@ from seq_queries.train import load_checkpoint
 from seq_queries.utils import write_pkl
 from seq_queries.sample import lm_proposal, uniform_proposal, beam_search_lower_bound, mc_estimate
 from seq_queries.experiments import sample_dynamic_target_token, prep_experiment
+from seq_queries.experiments import prep_experiment_cached, run_sweep, limit_queries, set_inference_backends, experiment_out_dir
+from seq_queries.experiments import sweep_work_items, make_out_dirs
 
 #################################################################################
 #   Function-Class Declaration
 #################################################################################
 
-device=0
+devices=None # All visible GPUs
 folders = ["ground_truth"]
 datasets = ['shakespeare','apps','amazon','moocs']
 config_path = "config/sample.yaml"
@@ -45,38 +47,38 @@ lengths = {
     "shakespeare":[(13,15),(12,15)],
 }
 
-for dataset_name in datasets:
-    len_info = lengths[dataset_name]
-    print("====="*10)
-    print(f"* Running for dataset {dataset_name}")
-    print("====="*10)
-    prep_dict = prep_experiment(config_path,
-                                dataset_name,
-                                device=device)
-    prep_dict['args'].text_dict['text'] = None
-    args = prep_dict['args']
-    val_dl = prep_dict['val_dl']
+set_inference_backends()
+
+def _run_cell(device, dataset_name, folder, hist_len, total_seq_len):
+    extra_args = {"amp_dtype":None} # Ground truth is enumerated in full precision
+    prep_dict = prep_experiment_cached(config_path,
+                                       dataset_name,
+                                       device=device,
+                                       extra_args=extra_args)
+    if ('val_batches', None) not in prep_dict:
+        # Batches are collated once and reused for every configuration
+        prep_dict[('val_batches', None)] = limit_queries(prep_dict['val_dl'])
+    val_dl = prep_dict[('val_batches', None)]
     model = prep_dict['model']
-    text_dict = args.text_dict
-    args.text_dict = None
-    print_args(vars(args))
-    args.text_dict = text_dict
+
+    args = copy.copy(prep_dict['args']) # text is cleared on prep, shallow copy is enough
+    args.estimate_type = beam_search_lower_bound
+    args.min_variance = False
+    args.num_beams = 0.0
+    args.hist_len = hist_len
+    args.total_seq_len = total_seq_len
+    print("[{}] | Dataset: {} | Sample type: {} | Hist length {} | Total Seq Length {}"\
+          .format(datetime.now(),dataset_name,folder,args.hist_len,args.total_seq_len))
+    with torch.inference_mode():
+        estimates = sample_dynamic_target_token(args, val_dl, model)
+    estimates['metadata']['text_dict']['text'] = None
+    write_pkl(estimates, experiment_out_dir(folder, dataset_name) /
+            f"val-dl_{dataset_name}_{folder.replace('_','-')}_{args.hist_len}h_{args.total_seq_len}s.pkl")
+    estimates=None
     print("====="*10)
 
-    for folder in folders:
-        for hist_len,total_seq_len in len_info:
-            args = copy.deepcopy(prep_dict['args'])
-            args.estimate_type = beam_search_lower_bound
-            args.min_variance = False
-            args.num_beams = 0.0
-            args.hist_len = hist_len
-            args.total_seq_len = total_seq_len
-            print("[{}] | Dataset: {} | Sample type: {} | Hist length {} | Total Seq Length {}"\
-                  .format(datetime.now(),dataset_name,folder,args.hist_len,args.total_seq_len))
-            estimates = sample_dynamic_target_token(args, val_dl, model)
-            os.makedirs(f"data/{folder}/{dataset_name}/val_dl/",exist_ok=True)
-            estimates['metadata']['text_dict']['text'] = None
-            write_pkl(estimates,
-                    f"data/{folder}/{dataset_name}/val_dl/val-dl_{dataset_name}_{folder.replace('_','-')}_{args.hist_len}h_{args.total_seq_len}s.pkl")
-            estimates=None
-            print("====="*10)
+work_items = sweep_work_items(datasets, folders, lengths)
+
+if __name__ == "__main__":
+    make_out_dirs(work_items)
+    run_sweep(_run_cell, work_items, devices=devices)
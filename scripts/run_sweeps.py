@@ -0,0 +1,56 @@
+#################################################################################
+#
+#             Project Title:  Combined experiment sweeps
+#             Date:           2022-05-02
+#
+#################################################################################
+
+
+#################################################################################
+#   Module Imports
+#################################################################################
+
+import os
+import sys
+import argparse
+
+ROOT =os.path.abspath(os.path.join(__file__,"../../"))
+sys.path.insert(1,ROOT)
+
+import beam_search_ablation
+import get_beam_search_lower_bound
+import get_ground_truth
+from seq_queries.experiments import run_sweep, make_out_dirs
+
+#################################################################################
+#   Function-Class Declaration
+#################################################################################
+
+experiment_roster = {
+    "ablation": beam_search_ablation,
+    "lower_bound": get_beam_search_lower_bound,
+    "ground_truth": get_ground_truth,
+}
+
+def _run_cell(device, experiment, *item):
+    experiment_roster[experiment]._run_cell(device, *item)
+
+if __name__ == "__main__":
+    # Runs the cells of several experiment scripts in one sweep, so each worker
+    # loads every dataset and model once and reuses it across experiments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--experiments", type=str, default="ablation,lower_bound,ground_truth",
+                        help="Comma separated experiments to run: ablation, lower_bound, ground_truth")
+    cli_args = parser.parse_args()
+
+    work_items = []
+    for experiment in cli_args.experiments.split(","):
+        assert experiment in experiment_roster,\
+            f"Experiment {experiment} not found in roster"
+        experiment_items = experiment_roster[experiment].work_items
+        make_out_dirs(experiment_items)
+        work_items += [(experiment, *item) for item in experiment_items]
+
+    # Cells of the same dataset are kept together (stable sort keeps experiment order)
+    work_items.sort(key=lambda item: item[1])
+    run_sweep(_run_cell, work_items)
@@ -115,6 +115,10 @@ def model_config_args(parser):
     group.add_argument("--vocab_size", type=int, default=-1, help="Number of unique vocabulary terms to embed and predict. A value of -1 means this will be inferred by the dataset.")
     group.add_argument("--hidden_size", type=int, default=32, help="Size of hidden state of RNN.")
     group.add_argument("--num_layers", type=int, default=3, help="Number of RNN layers.")
+    group.add_argument("--int8_output", type=_str2bool, default=False, help="Dynamically quantize the output (vocab) projection of RNN language models to int8. CPU only.")
+    group.add_argument("--use_jit", type=_str2bool, default=False, help="TorchScript the RNN of the language model for inference (ignored for GPT-2).")
+    group.add_argument("--use_compile", type=_str2bool, default=False, help="torch.compile the per-step scoring and min-variance filtering of beam search and the proposal step of importance sampling.")
+    group.add_argument("--amp_dtype", type=str, default=None, help="Autocast dtype for inference forward passes ('bf16' or 'fp16'). None keeps full precision.")
     group.add_argument("--dropout", type=float, default=0.2, help="Dropout rate to be applied to all supported layers during training.")
 
 def training_args(parser):
@@ -169,8 +173,11 @@ def sampling_args(parser):
     group.add_argument("--bs_ablation_max_beams", type=int, default=10000, help="Beam search ablation, checks on intermediate runs from function")
     group.add_argument("--min_var_reduction", type=float, default=0.0, help="Minimum variance reduction for minimum variance technique (otherwise, take all beams)")
     group.add_argument("--hybrid_max_num_beams", type=int, default=1500, help="Maximum_number of beams the hybrid can hold at each step")
+    group.add_argument("--top_p_candidates", type=int, default=None, help="Candidates per row sorted for coverage (top p) beam search, the full row is sorted only when they fall short of the coverage (None always sorts the full row)")
+    group.add_argument("--max_active_beams", type=int, default=None, help="Beams held before batched beam search stops admitting new queries (None uses batch_size)")
     group.add_argument("--num_beams", type=_int_or_float, default=10, help="Beam coverage (or number)")
     group.add_argument("--num_mc_samples", type=int, default=10, help="Number of MC samples")
+    group.add_argument("--share_prefix_cache", type=_str2bool, default=True, help="Encode each history once and share its hidden state across all samples")
     group.add_argument("--disable_tqdm", type=_str2bool,default=False,help="Disable tqdm monitoring runs for samplers")
 
 def print_args(args):
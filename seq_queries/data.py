@@ -137,6 +137,7 @@ def process_amazon_data(text_dict, args,
             batch_size=args.batch_size,
             shuffle=False,
             num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
         )
     if need_test:
         test_dl = torch.utils.data.DataLoader(
@@ -144,6 +145,7 @@ def process_amazon_data(text_dict, args,
             batch_size=args.batch_size,
             shuffle=False,
             num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
         )
 
     return train_dl, valid_dl, test_dl
@@ -231,6 +233,7 @@ def process_wikitext_data(text_dict, args,**kwargs): # batch_size, seq_len, dev=
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     return None, valid_dl, None
@@ -333,12 +336,14 @@ def process_app_mooc_data(text_dict, args,**kwargs): # batch_size, seq_len, dev=
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
     )
     test_dl = torch.utils.data.DataLoader(
         test_ids,
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     return train_dl, valid_dl, test_dl
@@ -382,12 +387,14 @@ def process_text_data(text_dict, args,**kwargs): # batch_size, seq_len, dev=torc
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
     )
     test_dl = torch.utils.data.DataLoader(
         test_ids,
         batch_size=args.batch_size,
         shuffle=False,
         num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     return train_dl, valid_dl, test_dl
@@ -12,18 +12,20 @@
 
 import os
 import sys
+import pathlib
 import numpy as np
 from collections import defaultdict
 from itertools import product
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.multiprocessing as mp
 from datetime import datetime
 
 from tqdm import tqdm
 # from .data import load_text, process_data
 from .model import CausalLM, MaskedLM
-from .arguments import get_args
+from .arguments import get_args, print_args
 from .tree import BeamSearchSampleTree
 from .sample import *
 from .data import *
@@ -159,6 +161,16 @@ def prep_experiment(
     model = get_model(args)
     if args.checkpoint_path:
         load_checkpoint(args, model)
+    if args.int8_output and not args.use_gpt2:
+        # Dynamic int8 linear kernels only exist for CPU
+        if torch.device(device).type == 'cpu':
+            # Only the output (vocab) projection is quantized, by submodule name
+            model = torch.ao.quantization.quantize_dynamic(model, {'out_transform'}, dtype=torch.qint8)
+        else: print("int8_output is only supported on cpu, keeping full precision output layer")
+    if args.use_jit and not args.use_gpt2:
+        # Only the recurrent core is scripted, the wrapper handles the varying state inputs
+        model.rnn = torch.jit.script(model.rnn)
+    model.amp_dtype = args.amp_dtype
     model.eval()
     print("====="*10)
 
@@ -318,8 +330,11 @@ def flashy_query(
                          disable=args.disable_tqdm):
         sample = torch.LongTensor(sample)
         if args.dataset == "flashy_apps":
-            args.excluded_terms = list(set(range(args.vocab_size)) - set([sample[0].item()]))
-            all_excluded_terms.append(torch.LongTensor(args.excluded_terms))
+            # Every term but the first one of the sequence
+            excluded_terms = torch.arange(args.vocab_size)
+            excluded_terms = excluded_terms[excluded_terms != sample[0]]
+            args.excluded_terms = excluded_terms.tolist()
+            all_excluded_terms.append(excluded_terms)
 
         if (args.use_gpt2 and
             args.disable_tqdm):
@@ -631,12 +646,157 @@ def beam_search_ablation(
     output['metadata'] = vars(args)
     return output
 
-#######################################################################
-# Static token
-#######################################################################
+@torch.no_grad()
+def beam_search_batched(
+    args,
+    prefixes,
+    model=None,
+    search_artifacts=['num_beams_over_time'],
+    coverages=None,
+    **kwargs,):
+    """Batched version of `beam_search_ablation`. All queries
+    are searched together rather than one at a time
+
+    :args: Experiment arguments
+    :prefixes: Stacked query sequences (num_queries x >= hist_len)
+    :model: Language model
+    :search_artifacts: Keys of search output to store
+    :coverages: List of coverages searched in the same run (instead of args.num_beams)
+    :returns: Output dictionary, each artifact stacked over queries.
+              One per coverage (keyed by coverage) if coverages are given
 
+    """
+    args.model = model; print();
+    args.seq_len = args.total_seq_len - args.hist_len
+    args.excluded_terms = []
+
+    kwargs = dict(vars(args))
+    # Identical histories give identical searches, so each is only searched once
+    hists, query_inds = torch.unique(prefixes[:,:args.hist_len], dim=0, return_inverse=True)
+    num_hists = hists.shape[0]
+    if coverages is not None:
+        # Every coverage gets its own copy of the histories, searched side by side
+        kwargs['num_beams'] = torch.tensor(coverages, dtype=torch.float64).repeat_interleave(num_hists)
+        hists = hists.repeat(len(coverages), 1)
+    search_output = beam_search_lower_bound_batched(hists,**kwargs)
+    args.model = None
 
+    query_inds = query_inds.cpu()
+    outputs = {}
+    for c, coverage in enumerate(coverages if coverages is not None else [args.num_beams]):
+        output = {}
+        for art in search_artifacts:
+            output[art] = (search_output[art][c*num_hists:(c+1)*num_hists][query_inds]
+                           if search_output[art].numel() else search_output[art])
+        output['metadata'] = dict(vars(args), num_beams=coverage)
+        outputs[coverage] = output
+    return outputs if coverages is not None else outputs[args.num_beams]
 
+#######################################################################
+# Static token
+#######################################################################
 
+#######################################################################
+# Sweeps over independent experiment cells
+#######################################################################
 
+def set_inference_backends():
+    """Backend flags for the experiment scripts. cuDNN autotuning is off since beam
+    counts change every step and it would re-run on each new shape, TF32 is on
+    for the vocab projection."""
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+def experiment_out_dir(folder, dataset_name):
+    """Output folder of an experiment's cells for one dataset."""
+    return pathlib.Path(f"data/{folder}/{dataset_name}/val_dl")
+
+_prep_cache = {}
+
+def prep_experiment_cached(config_path, name, device=0, extra_args={}, **kwargs):
+    """`prep_experiment` run once per (config, dataset, device, extra args) in each
+    process. Dataset text is cleared and arguments printed on first use.
+    `max_num_queries` is not applied, so experiments with different query limits
+    share the prep; callers apply it with `limit_queries`. `amp_dtype` is not
+    part of the key either, it is applied to the shared model on every call."""
+    amp_args = {k:v for k,v in extra_args.items() if k == 'amp_dtype'}
+    extra_args = {k:v for k,v in extra_args.items() if k not in ('max_num_queries','amp_dtype')}
+    key = (config_path, name, str(device), tuple(sorted(extra_args.items())))
+    if key not in _prep_cache:
+        print("====="*10)
+        print(f"* Running for dataset {name} on device {device}")
+        print("====="*10)
+        prep_dict = prep_experiment(config_path, name, device=device,
+                                    extra_args=extra_args, **kwargs)
+        prep_dict['args'].text_dict['text'] = None
+        text_dict = prep_dict['args'].text_dict
+        prep_dict['args'].text_dict = None
+        print_args(vars(prep_dict['args']))
+        prep_dict['args'].text_dict = text_dict
+        print("====="*10)
+        prep_dict['config_amp_dtype'] = prep_dict['args'].amp_dtype
+        _prep_cache[key] = prep_dict
+    prep_dict = _prep_cache[key]
+    amp_dtype = amp_args.get('amp_dtype', prep_dict['config_amp_dtype'])
+    prep_dict['args'].amp_dtype = prep_dict['model'].amp_dtype = amp_dtype
+    return prep_dict
+
+def limit_queries(batches, max_num_queries=None):
+    """List of query batches holding the first `max_num_queries` queries."""
+    if not max_num_queries: return list(batches)
+    limited, num_queries = [], 0
+    for dbatch in batches:
+        if num_queries >= max_num_queries: break
+        limited.append(dbatch[:max_num_queries - num_queries])
+        num_queries += limited[-1].shape[0]
+    return limited
+
+def sweep_work_items(datasets, folders, cells, group_last=False):
+    """Argument tuples (dataset, folder, *cell) of a sweep, `cells` maps each dataset
+    to its cells. With `group_last`, cells differing only in their last value are
+    merged into one cell holding the list of those values."""
+    work_items = [(dataset_name, folder, *cell)
+                  for dataset_name in datasets
+                  for folder in folders
+                  for cell in cells[dataset_name]]
+    if not group_last: return work_items
+    grouped = defaultdict(list)
+    for *cell, value in work_items:
+        grouped[tuple(cell)].append(value)
+    return [(*cell, values) for cell, values in grouped.items()]
+
+def make_out_dirs(work_items):
+    """Creates the output folders of a sweep once, before any cell runs."""
+    for dataset_name, folder in {item[:2] for item in work_items}:
+        experiment_out_dir(folder, dataset_name).mkdir(parents=True, exist_ok=True)
+
+def _sweep_worker(rank, run_cell, work_queue, devices):
+    while True:
+        item = work_queue.get()
+        if item is None: break
+        run_cell(devices[rank], *item)
+
+def run_sweep(run_cell, work_items, devices=None):
+    """Runs independent experiment cells with one worker process per device.
+    Workers pull `run_cell(device, *item)` calls from a shared queue, so cells
+    of uneven cost balance across devices. A single device runs in process.
+
+    :run_cell: Module level function taking (device, *item)
+    :work_items: List of argument tuples, one per cell
+    :devices: Devices to use, defaults to all visible GPUs
+    """
+    if devices is None:
+        devices = list(range(torch.cuda.device_count())) or ['cpu']
+    # Needed for deterministic cuBLAS, inherited by spawned workers
+    os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG", ":4096:8")
+    if len(devices) == 1:
+        for item in work_items:
+            run_cell(devices[0], *item)
+        return
+
+    work_queue = mp.get_context('spawn').Queue()
+    for item in work_items: work_queue.put(item)
+    for _ in devices: work_queue.put(None)
+    mp.spawn(_sweep_worker, args=(run_cell, work_queue, devices), nprocs=len(devices))
 
@@ -21,7 +21,7 @@ import torch.nn.functional as F
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
 from datasets import load_dataset
 
-from .utils import read_pkl, write_pkl, write_json, _tup_cpu, _tup_gpu_gpt2, _tup_cpu_gpt2
+from .utils import read_pkl, write_pkl, write_json, _tup_cpu, _tup_gpu_gpt2, _tup_cpu_gpt2, _autocast
 
 #################################################################################
 #   Function-Class Declaration
@@ -70,6 +70,7 @@ def load_GPT2_query_lm(device):
     print(total_params)
     model.model_iters = 0
     model.temperature = None
+    model.amp_dtype = None
 
     @torch.no_grad()
     def get_next_probs(self,
@@ -97,15 +98,16 @@ def load_GPT2_query_lm(device):
         prob_outputs = []; step_outputs = []
         for x, hidden_state in zip(xs, hidden_states):
             hidden_state = _tup_gpu_gpt2(hidden_state,device)
-            step_output = self.forward(
-                input_ids=x.to(device),
-                past_key_values=hidden_state,
-                use_cache=True,
-                return_dict=True,
-            )
+            with _autocast(device, self.amp_dtype):
+                step_output = self.forward(
+                    input_ids=x.to(device, non_blocking=True).long(),
+                    past_key_values=hidden_state,
+                    use_cache=True,
+                    return_dict=True,
+                )
             if not return_forward_only:
-                logits = step_output["logits"][:, -1, :] / temperature # last position in the sequence
-            else: logits = step_output['logits']/temperature
+                logits = step_output["logits"][:, -1, :].float() / temperature # last position in the sequence
+            else: logits = step_output['logits'].float()/temperature
             if not return_logits:
                 probs = torch.softmax(logits, dim=-1)
                 prob_outputs.append(probs.cpu())
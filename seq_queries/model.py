@@ -19,7 +19,7 @@ import torch.nn.functional as F
 import random
 
 from abc import ABC, abstractmethod
-from .utils import _tup_cpu, accuracy_score
+from .utils import _tup_cpu, _autocast, accuracy_score
 from .gpt2_model import load_GPT2_query_lm
 
 #################################################################################
@@ -61,6 +61,7 @@ class CausalLM(LM, nn.Module):
         self.out_transform = nn.Linear(embed_dim, vocab_size, bias=True)
         self.loss_func = nn.CrossEntropyLoss()
         self.temperature = None
+        self.amp_dtype = None
 
     def forward(self, src, rnn_args=None, **kwargs):
         """Takes in LongTensor `src` of size [batch_size, seq_len] and produces logits
@@ -106,11 +107,12 @@ class CausalLM(LM, nn.Module):
 
     def get_next_probs(self, x, rnn_args=None, temperature=1.0,
                          max_batch_size=128, device='cpu',
-                       return_forward_only=False,return_logits=True, **kwargs):
+                       return_forward_only=False,return_logits=True, keep_on_device=False, **kwargs):
         """Computes the probability distribution over the vocabulary for the next
         term in a sequence. Returns this and resulting hidden state. Can specify a
         temperature to divide the logits by prior to performing a softmax to change
-        how 'peaked' or 'flat' the distribution is."""
+        how 'peaked' or 'flat' the distribution is. Outputs are moved to cpu unless
+        `keep_on_device` is set."""
 
         # Model temperature always defaults to 1, must set to None to overwrite
         self.model_iters += x.shape[0] * x.shape[1]
@@ -122,8 +124,9 @@ class CausalLM(LM, nn.Module):
                 # Need to split up hidden states
                 assert x.shape[0] == rnn_args[0].shape[1] == rnn_args[1].shape[1],\
                     f"Sizes were x: {x.shape}, rnn1 {rnn_args[0].shape}, rnn2 {rnn_args[1].shape}"
-                rnn_args = list(zip(*(torch.split(rnn_args[0], max_batch_size, dim =1),
-                                torch.split(rnn_args[1],max_batch_size, dim =1))))
+                if len(xs) == 1: rnn_args = [rnn_args]
+                else: rnn_args = list(zip(torch.split(rnn_args[0], max_batch_size, dim =1),
+                                          torch.split(rnn_args[1],max_batch_size, dim =1)))
             else: rnn_args = torch.split(rnn_args,max_batch_size)
         else: rnn_args = [None]*len(xs)
 
@@ -131,23 +134,32 @@ class CausalLM(LM, nn.Module):
         step_outputs = []
         for x, rnn_arg, in zip(xs, rnn_args):
             if isinstance(rnn_arg,tuple):
-                rnn_arg_cuda = (rnn_arg[0].to(device),rnn_arg[1].to(device))
+                # States may be expanded views of a shared prefix, the RNN kernel needs them dense
+                rnn_arg_cuda = (rnn_arg[0].to(device, non_blocking=True).contiguous(),
+                                rnn_arg[1].to(device, non_blocking=True).contiguous())
                 assert x.shape[0] == rnn_arg[0].shape[1] == rnn_arg[1].shape[1],\
                     f"Sizes were x: {x.shape[0]}, rnn1 {rnn_arg[0].shape[1]}, rnn2 {rnn_arg[1].shape[1]}"
             elif rnn_arg is not None: rnn_arg.to(device)
-            step_output = self.forward(src=x.to(device), rnn_args=rnn_arg_cuda if rnn_arg else None)
+            with _autocast(device, self.amp_dtype):
+                step_output = self.forward(src=x.to(device, non_blocking=True).long(), rnn_args=rnn_arg_cuda if rnn_arg else None)
+            # Softmax and probability accumulation stay in full precision
             if not return_forward_only:
-                logits = step_output["logits"][:, -1, :] / temperature # last position in the sequence
-            else: logits = step_output['logits']/temperature
+                logits = step_output["logits"][:, -1, :].float() / temperature # last position in the sequence
+            else: logits = step_output['logits'].float()/temperature
             if not return_logits:
-                probs = torch.softmax(logits, dim=-1)
-                prob_outputs.append(probs.cpu())
+                logits = torch.softmax(logits, dim=-1)
+            if keep_on_device:
+                prob_outputs.append(logits)
+                step_outputs.append(step_output['misc_output'])
             else:
                 prob_outputs.append(logits.cpu())
-            step_outputs.append(_tup_cpu(step_output['misc_output']))
+                step_outputs.append(_tup_cpu(step_output['misc_output']))
 
+        # A single batch needs no concatenation (and no copy)
+        if len(step_outputs) == 1:
+            return prob_outputs[0], step_outputs[0]
         # If we have a LSTM
-        if isinstance(step_outputs[0], tuple):
+        elif isinstance(step_outputs[0], tuple):
             hidden, context = zip(*step_outputs)
             hidden = torch.cat(hidden, dim = 1)
             context = torch.cat(context, dim = 1)
@@ -158,6 +170,15 @@ class CausalLM(LM, nn.Module):
 
         return torch.cat(prob_outputs,dim = 0), step_output
 
+    def encode_prefix(self, hist, max_batch_size=128, device='cpu', keep_on_device=False, **kwargs):
+        """Runs a history through the model a single time and returns the next token
+        logits and resulting hidden state, so that every sample extending the history
+        can start from this state instead of reprocessing the prefix."""
+        if len(hist.shape) == 1:
+            hist = hist.unsqueeze(0)
+        return self.get_next_probs(hist, rnn_args=None, max_batch_size=max_batch_size,
+                                   device=device, return_logits=True, keep_on_device=keep_on_device)
+
     @torch.no_grad()
     def sample(
         self,
@@ -12,11 +12,12 @@
 import os
 import sys
 import copy
+import math
 import time
+import functools
 from collections import defaultdict
 import pickle as pkl
 
-import numpy as np
 import random
 import torch
 import torch.nn as nn
@@ -30,15 +31,32 @@ from .tree import BeamSearchSampleTree
 #   Function-Class Declaration
 #################################################################################
 
+def _expand_prefix_state(prefix_state, num_rows):
+    """Broadcasts the (logits, hidden state) of a single encoded history to `num_rows`.
+    Returns expanded views, states are made contiguous per batch in `get_next_probs`"""
+    logits, states = prefix_state
+    logits = logits.expand(num_rows, -1)
+    if isinstance(states, tuple):
+        states = tuple(s.expand(-1, num_rows, -1) for s in states)
+    else:
+        states = states.expand(-1, num_rows, -1)
+    return logits, states
+
+def _gumbel_sample(logits):
+    """Draws one token per row from softmax(`logits`) with the Gumbel-max trick.
+    Avoids constructing and validating a Categorical distribution each step."""
+    gumbels = -torch.empty_like(logits).exponential_().log()
+    return torch.argmax(logits + gumbels, dim=-1)
+
 def uniform_proposal(hists, seq_len, model, vocab_size, excluded_terms,
                      batch_size, device='cpu', **kwargs):
     assert(len(hists.shape) == 2)
 
-    # Uniformly sample across the restricted vocabulary indices
-    samples = torch.randint(low=0, high=vocab_size-len(excluded_terms), size=(hists.shape[0], seq_len), device=hists.device)
-    for item in sorted(excluded_terms):
-        samples[samples>=item] += 1
-    assert(samples.max() < vocab_size)
+    # Uniformly sample across the restricted vocabulary indices, all rows and steps in one draw
+    allowed = torch.ones(vocab_size, dtype=torch.bool, device=hists.device)
+    allowed[list(excluded_terms)] = False
+    allowed = allowed.nonzero().squeeze(-1)
+    samples = allowed[torch.randint(low=0, high=allowed.shape[0], size=(hists.shape[0], seq_len), device=hists.device)]
 
     logits,hidden_states = model.get_next_probs(torch.cat((hists, samples), dim=-1), return_forward_only=True,
                                                 device=device, return_logits=True, max_batch_size=batch_size)  #, device=device)
@@ -47,7 +65,7 @@ def uniform_proposal(hists, seq_len, model, vocab_size, excluded_terms,
     model_log_prob = torch.gather(model_log_prob, dim=-1, index=samples.unsqueeze(-1)).squeeze(-1).sum(dim=-1)  # grab specific log probabilities
 
     return {
-        "proposal_log_prob": -seq_len * np.log(vocab_size - len(excluded_terms)),
+        "proposal_log_prob": -seq_len * math.log(vocab_size - len(excluded_terms)),
         "model_log_prob": model_log_prob.unsqueeze(-1),
         "samples": samples,
         "logits": logits,
@@ -57,58 +75,64 @@ def uniform_proposal(hists, seq_len, model, vocab_size, excluded_terms,
     }
 
 def lm_proposal(hists, seq_len, model, vocab_size, excluded_terms,
-                batch_size=128,device='cpu',top_k=0, top_p=1.0, temperature=1.0,  **kwargs):
+                batch_size=128,device='cpu',top_k=0, top_p=1.0, temperature=1.0,
+                prefix_state=None, use_compile=False, **kwargs):
     assert(len(hists.shape) == 2)
 
-    proposal_log_prob, model_log_prob = 0.0, 0.0
-    intermediate_query_probs = []; entropy_probs = []
-    samples = []; all_logits = []; started = False
+    excluded_mask = torch.zeros((vocab_size,), dtype=torch.bool)
+    excluded_mask[excluded_terms] = True
+    proposal_step = _maybe_compile(_proposal_step, use_compile)
+    # Outputs are written in place each step (model outputs are returned on cpu)
+    num_rows = hists.shape[0]
+    proposal_log_prob, model_log_prob = torch.zeros((num_rows,)), torch.zeros((num_rows,))
+    intermediate_query_probs = torch.empty((num_rows, seq_len, vocab_size))
+    entropy_probs = torch.empty((num_rows, seq_len + 1))
+    samples = torch.empty((num_rows, seq_len), dtype=torch.long)
+    all_logits = torch.empty((num_rows, seq_len + 1, vocab_size)); started = False
     last_sample, rnn_args = hists, None
-    for _ in range(seq_len):
-        logits, rnn_args = model.get_next_probs(last_sample, rnn_args=rnn_args, max_batch_size=batch_size,
-                                                device=device, return_logits=True)
+    for n_cur in range(seq_len):
+        if n_cur == 0 and prefix_state is not None:
+            # History was already encoded once, reuse it for every sample in the batch
+            logits, rnn_args = _expand_prefix_state(prefix_state, hists.shape[0])
+        else:
+            logits, rnn_args = model.get_next_probs(last_sample, rnn_args=rnn_args, max_batch_size=batch_size,
+                                                    device=device, return_logits=True)
         if not started: model.model_iters = 0; started= True
-        all_logits.append(logits)
+        all_logits[:, n_cur] = logits
 
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
-        proposal_logits = torch.log_softmax(top_k_top_p_filtering(proposal_logits/temperature, top_k=top_k, top_p=top_p), dim=-1)
-        logits = torch.log_softmax(logits, dim=-1)
+        logits, last_sample, sample_proposal_log_prob, sample_model_log_prob = proposal_step(
+            logits, excluded_mask, temperature, top_k, top_p)
 
-        if isinstance(model_log_prob,float) and isinstance(proposal_log_prob,float):
-            intermediate_query_probs.append(logits.exp())
-        else: intermediate_query_probs.append((logits + model_log_prob.unsqueeze(-1)
-                                               - proposal_log_prob.unsqueeze(-1)).exp().cpu())
+        intermediate_query_probs[:, n_cur] = (logits + model_log_prob.unsqueeze(-1)
+                                              - proposal_log_prob.unsqueeze(-1)).exp()
 
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
-        proposal_log_prob += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze()
-        model_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze()
+        proposal_log_prob += sample_proposal_log_prob
+        model_log_prob += sample_model_log_prob
 
-        entropy_probs.append(-proposal_log_prob)
-        samples.append(last_sample)
+        entropy_probs[:, n_cur] = -proposal_log_prob
+        samples[:, n_cur] = last_sample.squeeze(-1)
 
     logits, _ = model.get_next_probs(last_sample, rnn_args=rnn_args, device=device,
                                      max_batch_size=batch_size,return_logits=True)  # get last subsequent distribution
-    all_logits.append(logits)
+    all_logits[:, seq_len] = logits
     logits = torch.log_softmax(logits, dim=-1)
 
     # Use this for frequentist statistics
-    last_sample = torch.distributions.Categorical(logits=logits).sample().unsqueeze(-1)
+    last_sample = _gumbel_sample(logits).unsqueeze(-1)
     # batch (batch_size) (1 if in excluded terms else 0)
     proposal_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
     model_log_prob += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
-    entropy_probs.append(-proposal_log_prob)
+    entropy_probs[:, seq_len] = -proposal_log_prob
 
-    samples = torch.cat(samples, dim=-1)
     return {
         "proposal_log_prob": proposal_log_prob.unsqueeze(-1),
         "model_log_prob": model_log_prob.unsqueeze(-1),
         "samples": samples,
         "last_sample":last_sample,
-        "logits": torch.stack(all_logits,dim=1),
+        "logits": all_logits,
         "next_log_dist": logits,
-        "intermediate_query_probs": torch.stack(intermediate_query_probs,dim=1),
-        "entropy_probs": torch.stack(entropy_probs,dim=-1),
+        "intermediate_query_probs": intermediate_query_probs,
+        "entropy_probs": entropy_probs,
     }
 
 
@@ -117,12 +141,16 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
                  min_num_mc_samples, max_num_mc_samples, variance_epsilon, vocab_size,
                  var_check_interval=1000, batch_size=128,temperature=1, top_k=0, top_p=0.0,
                  device='cpu', cat_list = ['sample_estimates', 'intermediate_query_probs'],
-                sub_estimates=None,**kwargs):
+                sub_estimates=None,use_gpt2=False,share_prefix_cache=True,use_compile=False,**kwargs):
 
     # _set_random_seed(int(time.time()) %2**32)
     model.model_iters = 0
     assert(len(hist.shape) == 1)  # (hist_seq_len), Only conditions on a single history
     assert(len(excluded_terms) == 0) # For most experiments, this will be 1. For Q2 it is zero
+    prefix_state = None
+    # Only the lm proposal conditions on the history state
+    if share_prefix_cache and not use_gpt2 and proposal_func is lm_proposal:
+        prefix_state = model.encode_prefix(hist, max_batch_size=batch_size, device=device)
     temp_out_dict = defaultdict(list)
     out_dict = defaultdict(list)
     samp_est_var = 1.0 # Some general seeding
@@ -145,6 +173,8 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
                 device=device,
                 batch_size=batch_size,
                 temperature=temperature,
+                prefix_state=prefix_state,
+                use_compile=use_compile,
             )
 
             remaining_samples -= batch_size
@@ -179,13 +209,18 @@ def mc_pseudo_gt(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_
 def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_func,
                 vocab_size, batch_size=128,temperature=1, top_k=0, top_p=0.0, device='cpu',
                 cat_list = ['sample_estimates','entropy_probs', 'intermediate_query_probs'],
-                flashy =False,frequentist_test=False,sub_estimates=None,**kwargs):
+                flashy =False,frequentist_test=False,sub_estimates=None,
+                use_gpt2=False,share_prefix_cache=True,use_compile=False,**kwargs):
     model.model_iters = 0
     model_iters = 0
     if frequentist_test:
         target_terms = excluded_terms
         excluded_terms = []
     assert(len(hist.shape) == 1)  # (hist_seq_len), Only conditions on a single history
+    prefix_state = None
+    # Only the lm proposal conditions on the history state
+    if share_prefix_cache and not use_gpt2 and proposal_func is lm_proposal:
+        prefix_state = model.encode_prefix(hist, max_batch_size=batch_size, device=device)
     out_dict = defaultdict(list)
     remaining_samples = num_mc_samples
     while remaining_samples > 0:
@@ -201,6 +236,8 @@ def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_f
             device=device,
             batch_size=batch_size,
             temperature=temperature,
+            prefix_state=prefix_state,
+            use_compile=use_compile,
         )
         remaining_samples -= batch_size
         term_log_prob = sample_out["next_log_dist"] + sample_out["model_log_prob"] - sample_out["proposal_log_prob"]
@@ -274,7 +311,6 @@ def mc_estimate(hist, num_mc_samples, seq_len, model, excluded_terms, proposal_f
         out_dict['sample_estimate_mean'] =out_dict['sample_estimates'].mean(dim=0)
     return out_dict
 
-
 #######################################################################
 # With replacement
 #######################################################################
@@ -332,6 +368,7 @@ def tree_is_estimate_attn(
     sub_estimates=None,
     **kwargs,
  ):
+    excluded_inds = torch.LongTensor(excluded_terms)  # built once, reused every step
     # Sample each sequence individually from tree
     dist_estimates = []
     total_model_iters = model.model_iters; model_iters = []
@@ -351,10 +388,9 @@ def tree_is_estimate_attn(
                 return_logits=True,
             )
 
-            proposal_logits = logits.clone()
-            proposal_logits[..., excluded_terms] = -float('inf')
+            proposal_logits = logits.index_fill(-1, excluded_inds, -float('inf'))
             logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-            last_token = torch.distributions.Categorical(logits=proposal_logits).sample()
+            last_token = _gumbel_sample(proposal_logits)
 
             log_q += proposal_logits[...,last_token].squeeze()
             log_p += logits[...,last_token].squeeze()
@@ -402,6 +438,58 @@ def tree_is_estimate_attn(
     }
 
 
+def _finish_tree_samples(model, last_tokens, hidden_states, num_remaining_steps,
+                         log_p_totals, log_q_totals, excluded_inds, batch_size, device):
+    """Samples the steps left after leaving the tree for every sequence from the model.
+    Sequences are ordered by remaining steps, so the unfinished ones are always a leading
+    slice and each step only runs the model on those. Returns the final next token log
+    distribution and the log p / log q totals, in the original sequence order."""
+    order = torch.argsort(num_remaining_steps, descending=True)
+    inverse = torch.argsort(order)
+    last_tokens = last_tokens[order]
+    log_p_totals, log_q_totals = log_p_totals[order], log_q_totals[order]
+    hidden_states = _select_states(hidden_states, order)
+    # Number of unfinished sequences at every step, read once
+    num_remaining_steps = num_remaining_steps[order]
+    steps = torch.arange(int(num_remaining_steps.max()) if num_remaining_steps.numel() else 0)
+    num_active_by_step = (num_remaining_steps.unsqueeze(0) > steps.unsqueeze(-1)).sum(dim=-1).tolist()
+
+    for num_active in num_active_by_step:
+        if isinstance(hidden_states, tuple):
+            rnn_args = (hidden_states[0][..., :num_active, :], hidden_states[1][..., :num_active, :])
+        else:
+            rnn_args = hidden_states[..., :num_active, :]
+        logits, rnn_args = model.get_next_probs(
+            last_tokens[:num_active, :],
+            rnn_args=rnn_args,
+            max_batch_size=batch_size,
+            device=device,
+            return_logits=True,
+        )
+
+        proposal_logits = logits.index_fill(-1, excluded_inds, -float('inf'))
+        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
+        last_sample = _gumbel_sample(proposal_logits).unsqueeze(-1)
+        log_q_totals[:num_active] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
+        log_p_totals[:num_active] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
+        if isinstance(hidden_states, tuple):
+            hidden_states[0][..., :num_active, :] = rnn_args[0]
+            hidden_states[1][..., :num_active, :] = rnn_args[1]
+        else:
+            hidden_states[..., :num_active, :] = rnn_args
+        last_tokens[:num_active, :] = last_sample
+
+    # Compute final distributions for estimate
+    next_log_dist, _ = model.get_next_probs(
+        last_tokens,
+        hidden_states,
+        max_batch_size=batch_size,
+        device=device,
+        return_logits=True,
+    )
+    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
+    return next_log_dist[inverse], log_p_totals[inverse], log_q_totals[inverse]
+
 @torch.no_grad()
 def tree_is_estimate_rnn(
     tree,
@@ -415,6 +503,7 @@ def tree_is_estimate_rnn(
     sub_estimates=None,
     **kwargs,
  ):
+    excluded_inds = torch.LongTensor(excluded_terms)  # built once, reused every step
     # Sample each sequence individually from tree
     log_p_totals, log_q_totals = [], []
     hidden_states, num_remaining_steps = [], []
@@ -445,9 +534,8 @@ def tree_is_estimate_rnn(
 
     if sub_estimates:
         model_iters = []
-        samples_per_effort = [
-            (num_remaining_steps == i).sum().item() for i in range(num_remaining_steps.max()+1)
-        ];
+        # Number of samples needing each count of remaining steps, counted in one pass
+        samples_per_effort = torch.bincount(num_remaining_steps).tolist()
         j = 0
         for i in range(len(sub_estimates)):
             total_samp = 0; total_cost = model.model_iters
@@ -462,43 +550,10 @@ def tree_is_estimate_rnn(
                     model_iters.append(total_cost)
                     break
 
-    while (num_remaining_steps > 0).any():
-        to_update = num_remaining_steps > 0
-        if isinstance(hidden_states, tuple):
-            rnn_args = (hidden_states[0][..., to_update, :], hidden_states[1][..., to_update, :])
-        else:
-            rnn_args = hidden_states[..., to_update, :]
-        logits, rnn_args = model.get_next_probs(
-            last_tokens[to_update, :],
-            rnn_args=rnn_args,
-            max_batch_size=batch_size,
-            device=device,
-            return_logits=True,
-        )
-
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
-        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
-        log_q_totals[to_update] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
-        log_p_totals[to_update] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
-        if isinstance(hidden_states, tuple):
-            hidden_states[0][..., to_update, :] = rnn_args[0]
-            hidden_states[1][..., to_update, :] = rnn_args[1]
-        else:
-            hidden_states[..., to_update, :] = rnn_args
-        num_remaining_steps[to_update] -= 1
-        last_tokens[to_update, :] = last_sample
-
-    # Compute final distributions for estimate
-    next_log_dist, _ = model.get_next_probs(
-        last_tokens,
-        hidden_states,
-        max_batch_size=batch_size,
-        device=device,
-        return_logits=True,
-    )
-    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
+    # Sequences are finished together, the batch shrinks as they complete
+    next_log_dist, log_p_totals, log_q_totals = _finish_tree_samples(
+        model, last_tokens, hidden_states, num_remaining_steps,
+        log_p_totals, log_q_totals, excluded_inds, batch_size, device)
     dist_estimate = next_log_dist + log_p_totals.unsqueeze(dim=-1) - log_q_totals.unsqueeze(dim=-1)
     dist_estimate = dist_estimate.exp().cpu()
     dist_est_var = dist_estimate.var(dim=0)
@@ -535,15 +590,58 @@ def lin_interp(target_pct, n_current, n_end):
     t = n_current / (n_end - 1)
     return a * (1 - t) + b * t
 
+@functools.lru_cache(maxsize=None)
+def _compiled(func):
+    return torch.compile(func, dynamic=True)
+
+def _token_dtype(vocab_size):
+    """Smallest integer dtype holding every vocabulary id, used to store beam tokens."""
+    return torch.int16 if vocab_size <= torch.iinfo(torch.int16).max else torch.int32
+
+def _maybe_compile(func, use_compile=False):
+    """Returns `func` compiled with torch.compile (dynamic shapes, since beam
+    counts change every step) if requested and available, else `func` itself."""
+    if use_compile and hasattr(torch, "compile"):
+        return _compiled(func)
+    return func
+
+def _proposal_step(logits, excluded_mask, temperature, top_k, top_p):
+    """Restricts and filters the next token logits into the proposal, draws one token
+    per row from it and returns the model log-probabilities, the drawn tokens and the
+    proposal and model log-probabilities of those tokens."""
+    proposal_logits = logits.masked_fill(excluded_mask, -float('inf'))
+    proposal_logits = torch.log_softmax(top_k_top_p_filtering(proposal_logits/temperature, top_k=top_k, top_p=top_p), dim=-1)
+    log_probs = torch.log_softmax(logits, dim=-1)
+    sample = _gumbel_sample(proposal_logits).unsqueeze(-1)
+    return (log_probs, sample,
+            torch.gather(proposal_logits, dim=-1, index=sample).squeeze(-1),
+            torch.gather(log_probs, dim=-1, index=sample).squeeze(-1))
+
+def _beam_step(logits, cur_log_probs, cur_restricted_log_probs, excluded_inds):
+    """Scores every one-token extension of the current beams. Returns the step
+    log-probabilities (unrestricted, and restricted to non-excluded terms) and the
+    flattened (beams*vocab) running log-probabilities for both."""
+    step_log_probs = torch.log_softmax(logits, dim=-1)
+    masked_log_probs = step_log_probs.index_fill(-1, excluded_inds, -float('inf'))
+    step_restricted_log_probs = torch.log_softmax(masked_log_probs, dim=-1)
+    next_log_probs = (cur_log_probs.unsqueeze(-1) + masked_log_probs).view(-1)
+    next_restricted_log_probs = (cur_restricted_log_probs.unsqueeze(-1) + step_restricted_log_probs).view(-1)
+    return step_log_probs, step_restricted_log_probs, next_log_probs, next_restricted_log_probs
+
 @torch.no_grad()
 def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
                             interp_func, batch_size, device, vocab_size, use_gpt2=False,
                             bs_tree=None, store_intermediate_lbs=False, sub_estimates=None,
                             min_variance=False,min_var_reduction=0.0,bs_ablation=False,
-                            bs_ablation_max_beams=10000,max_num_tree_beams=None, **kwargs):
+                            bs_ablation_max_beams=10000,max_num_tree_beams=None,
+                            top_p_candidates=None, use_compile=False, **kwargs):
     assert(isinstance(num_beams, (int, float)))
     assert(len(hist.shape) == 1)
 
+    beam_step = _maybe_compile(_beam_step, use_compile)
+    min_variance_filter = _maybe_compile(min_variance_top_k, use_compile)
+    excluded_inds = torch.LongTensor(excluded_terms)
+    token_dtype = _token_dtype(vocab_size)
     model.model_iters = 0; started = False; intermediate_lbs = []
     beams, rnn_args = hist.unsqueeze(0), None  # beams only represents what needs to be processed by the model in the next step
     cur_log_probs = torch.zeros((1,), dtype=torch.float32)  # (num of current beams,)
@@ -553,33 +651,24 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
         logits, states = model.get_next_probs(beams, rnn_args=rnn_args, return_logits = True,
                                             max_batch_size=batch_size,device=device)
         if not started: model.model_iters = 0; started= True
-        next_log_probs = torch.log_softmax(logits, dim=-1)  # (num of current beams, vocab_size)
+        # (num of current beams, vocab_size) step outputs, (num of current beams * vocab_size) running
+        (stored_next_log_probs, stored_restricted_log_probs,
+         next_log_probs, next_restricted_log_probs) = beam_step(logits, cur_log_probs,
+                                                                cur_restricted_log_probs, excluded_inds)
         # If we need to store intermediate results
         if store_intermediate_lbs:
             intermediate_lbs.append((cur_log_probs.unsqueeze(-1) +
-                                     next_log_probs).exp().sum(dim=0).cpu())
-
-        stored_next_log_probs = next_log_probs.clone()
-        # We need this for each symbol, (tracked based on beams, could use sequence id)
-        next_log_probs[..., excluded_terms] = -float('inf')
-        next_restricted_log_probs = torch.log_softmax(next_log_probs, dim=-1)
-        stored_restricted_log_probs = next_restricted_log_probs.clone()
-
-        next_log_probs = cur_log_probs.unsqueeze(-1) + next_log_probs
-
-
-        next_log_probs = next_log_probs.view(-1)
-        next_restricted_log_probs = cur_restricted_log_probs.unsqueeze(-1) + next_restricted_log_probs
-        next_restricted_log_probs = next_restricted_log_probs.view(-1)
+                                     stored_next_log_probs).exp().sum(dim=0).cpu())
 
         if min_variance:
-                next_restricted_log_probs = min_variance_top_k(next_restricted_log_probs, min_var_reduction=min_var_reduction,
+                next_restricted_log_probs = min_variance_filter(next_restricted_log_probs, min_var_reduction=min_var_reduction,
                                                                max_num_tree_beams=max_num_tree_beams,is_log_prob=True)
         elif isinstance(num_beams, int):
                 next_restricted_log_probs = top_k_top_p_filtering(next_restricted_log_probs, top_k=num_beams, is_log_prob=True)
         else:  # isinstance(num_beams, float)
             num_beams_cur = interp_func(num_beams, n_cur, seq_len)
-            next_restricted_log_probs = top_k_top_p_filtering(next_restricted_log_probs, top_p=num_beams_cur, is_log_prob=True)
+            next_restricted_log_probs = top_k_top_p_filtering(next_restricted_log_probs, top_p=num_beams_cur, is_log_prob=True,
+                                                              top_p_candidates=top_p_candidates)
 
         next_log_probs = next_log_probs.masked_fill(next_restricted_log_probs == -float('inf'), -float('inf'))
         if bs_tree is not None:
@@ -605,7 +694,7 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
         if n_cur ==0 and bs_tree is not None: parents = parents * indices.shape[0]
         # Sequence indices we will need for next piece
         seq_inds = torch.div(indices, vocab_size, rounding_mode='trunc')  # equivalent to: indices // args.vocab_size
-        beams = (indices % vocab_size).unsqueeze(-1)
+        beams = (indices % vocab_size).to(token_dtype).unsqueeze(-1)
         cur_log_probs = next_log_probs[indices]
         cur_restricted_log_probs = next_restricted_log_probs[indices]
         rnn_args = states
@@ -678,6 +767,187 @@ def beam_search_lower_bound(hist, num_beams, seq_len, model, excluded_terms,
     return out_dict
 
 
+def _filter_query_beams(log_probs, beam_qids, num_queries, filter_func):
+    """Applies `filter_func(rows, qids)` to the candidates of the queries in `qids`. The
+    (beams x vocab) candidates are laid out with one row per query (padded with -inf) and then
+    mapped back. Queries are grouped by beam count rounded up to a power of two, so a query is
+    padded to at most twice its own beams rather than to the largest query."""
+    counts = torch.bincount(beam_qids, minlength=num_queries)
+    beam_pos = torch.arange(beam_qids.shape[0], device=beam_qids.device) - (torch.cumsum(counts, 0) - counts)[beam_qids]
+    buckets = torch.ceil(torch.log2(counts.clamp(min=1).double())).long()
+    beam_buckets = buckets[beam_qids]
+    local_qids = beam_qids.new_empty(num_queries)
+    filtered = torch.empty_like(log_probs)
+    for bucket in torch.unique(buckets[counts > 0]).tolist():
+        qids = torch.nonzero((buckets == bucket) & (counts > 0)).squeeze(-1)
+        local_qids[qids] = torch.arange(qids.shape[0], device=qids.device)
+        beam_inds = torch.nonzero(beam_buckets == bucket).squeeze(-1)
+        rows_qids, rows_pos = local_qids[beam_qids[beam_inds]], beam_pos[beam_inds]
+        padded = log_probs.new_full((qids.shape[0], 2 ** bucket, log_probs.shape[-1]), -float('inf'))
+        padded[rows_qids, rows_pos] = log_probs[beam_inds]
+        padded = filter_func(padded.view(qids.shape[0], -1), qids).view(qids.shape[0], -1, log_probs.shape[-1])
+        filtered[beam_inds] = padded[rows_qids, rows_pos]
+    return filtered
+
+def _cat_states(states):
+    """Concatenates RNN hidden states (tuple for LSTM) along the batch dimension."""
+    if isinstance(states[0], tuple):
+        return tuple(torch.cat(s, dim=-2) for s in zip(*states))
+    return torch.cat(states, dim=-2)
+
+def _select_states(states, inds):
+    if isinstance(states, tuple):
+        return tuple(s.index_select(-2, inds) for s in states)
+    return states.index_select(-2, inds)
+
+@torch.no_grad()
+def beam_search_lower_bound_batched(hists, num_beams, seq_len, model, excluded_terms,
+                                    interp_func, batch_size, device, vocab_size, use_gpt2=False,
+                                    store_intermediate_lbs=False, sub_estimates=None,
+                                    min_variance=False,min_var_reduction=0.0,
+                                    max_num_tree_beams=None, max_active_beams=None, top_p_candidates=None,
+                                    use_compile=False, **kwargs):
+    """Beam search lower bound for a stack of histories of the same length (queries x hist_len).
+    The beams of all active queries are advanced together, so each step is a single model call.
+    Queries are admitted while fewer than `max_active_beams` beams are held (`batch_size` if None)
+    and leave as soon as they finish, freeing their rows for the next pending queries.
+    `excluded_terms` is either shared by all queries or holds one list per query, and
+    a coverage `num_beams` may also be given per query as a float tensor.
+    Model outputs and all bookkeeping stay on `device` until the search ends.
+    Returns the outputs of `beam_search_lower_bound` stacked over queries (first dimension)."""
+    assert(isinstance(num_beams, (int, float, torch.Tensor)))
+    assert(len(hists.shape) == 2)
+    assert not use_gpt2, "Batched beam search only supports RNN language models"
+    assert not sub_estimates, "Sub-estimates are not supported for batched beam search"
+
+    num_queries = hists.shape[0]
+    excluded_mask = torch.zeros((num_queries, vocab_size), dtype=torch.bool)
+    if len(excluded_terms) > 0 and isinstance(excluded_terms[0], (list, tuple)):
+        for q, terms in enumerate(excluded_terms):
+            excluded_mask[q, terms] = True
+    else:
+        excluded_mask[:, excluded_terms] = True
+    hists, excluded_mask = hists.to(device), excluded_mask.to(device)
+    min_variance_filter = _maybe_compile(min_variance_top_k, use_compile)
+    if isinstance(num_beams, torch.Tensor): num_beams = num_beams.to(device)
+    # The active set is bounded by one model batch, freed rows are refilled as queries finish
+    if max_active_beams is None: max_active_beams = batch_size
+
+    # Per query results, filled in as queries finish
+    bs_lower_bound = torch.zeros((num_queries, vocab_size), device=device)
+    true_coverage = torch.zeros((num_queries,), device=device)
+    restricted_coverage = torch.zeros((num_queries,), device=device)
+    num_beams_over_time = torch.zeros((num_queries, seq_len), dtype=torch.long, device=device)
+    intermediate_lbs = (torch.zeros((num_queries, seq_len + 1, vocab_size), device=device)
+                        if store_intermediate_lbs else None)
+
+    model.model_iters = 0
+    query_t = torch.zeros((num_queries,), dtype=torch.long, device=device)  # steps taken by each query
+    pending = torch.arange(num_queries, device=device)
+    token_dtype = _token_dtype(vocab_size)
+    beams, rnn_args = torch.zeros((0, 1), dtype=token_dtype, device=device), None
+    beam_qids = torch.zeros((0,), dtype=torch.long, device=device)  # query of each beam, beams stay grouped by query
+    cur_log_probs = torch.zeros((0,), dtype=torch.float32, device=device)
+    cur_restricted_log_probs = cur_log_probs.clone()
+    while pending.shape[0] > 0 or beam_qids.shape[0] > 0:
+        # Refill freed rows with the next pending queries
+        num_admit = max(max_active_beams - beam_qids.shape[0], int(beam_qids.shape[0] == 0))
+        new_qids, pending = pending[:num_admit], pending[num_admit:]
+
+        step_outputs = []
+        if beam_qids.shape[0] > 0:
+            step_outputs.append(model.get_next_probs(beams, rnn_args=rnn_args, return_logits = True,
+                                                     max_batch_size=batch_size,device=device,
+                                                     keep_on_device=True))
+        if new_qids.shape[0] > 0:
+            step_outputs.append(model.encode_prefix(hists[new_qids], max_batch_size=batch_size, device=device,
+                                                    keep_on_device=True))
+            beam_qids = torch.cat((beam_qids, new_qids))
+            cur_log_probs = torch.cat((cur_log_probs, cur_log_probs.new_zeros((new_qids.shape[0],))))
+            cur_restricted_log_probs = torch.cat((cur_restricted_log_probs,
+                                                  cur_restricted_log_probs.new_zeros((new_qids.shape[0],))))
+        logits = torch.cat([logits for logits, _ in step_outputs])
+        states = _cat_states([states for _, states in step_outputs])
+
+        next_log_probs = torch.log_softmax(logits, dim=-1)  # (num of current beams, vocab_size)
+        beam_t = query_t[beam_qids]
+        if store_intermediate_lbs:
+            intermediate_lbs.index_put_((beam_qids, beam_t),
+                (cur_log_probs.unsqueeze(-1) + next_log_probs).exp(), accumulate=True)
+
+        # Finished queries only needed their final distribution
+        done = beam_t == seq_len
+        if done.any():
+            done_qids = beam_qids[done]
+            bs_lower_bound.index_add_(0, done_qids, (cur_log_probs[done].unsqueeze(-1) + next_log_probs[done]).exp())
+            true_coverage.index_add_(0, done_qids, cur_log_probs[done].exp())
+            restricted_coverage.index_add_(0, done_qids, cur_restricted_log_probs[done].exp())
+
+            keep = torch.nonzero(~done).squeeze(-1)
+            next_log_probs, states = next_log_probs.index_select(0, keep), _select_states(states, keep)
+            beam_qids, cur_log_probs = beam_qids.index_select(0, keep), cur_log_probs.index_select(0, keep)
+            cur_restricted_log_probs = cur_restricted_log_probs.index_select(0, keep)
+            if beam_qids.shape[0] == 0: continue
+
+        next_log_probs = next_log_probs.masked_fill(excluded_mask[beam_qids], -float('inf'))
+        next_restricted_log_probs = torch.log_softmax(next_log_probs, dim=-1)
+        next_log_probs = cur_log_probs.unsqueeze(-1) + next_log_probs
+        next_restricted_log_probs = cur_restricted_log_probs.unsqueeze(-1) + next_restricted_log_probs
+
+        # Filter over active queries only
+        active_qids, active_inds = torch.unique_consecutive(beam_qids, return_inverse=True)
+        num_active = active_qids.shape[0]
+        if min_variance:
+            # Variance is taken over the unpadded candidates, so go query by query
+            query_sizes = (torch.bincount(active_inds, minlength=num_active) * vocab_size).tolist()
+            next_restricted_log_probs = torch.cat([
+                min_variance_filter(query_log_probs, min_var_reduction=min_var_reduction,
+                                   max_num_tree_beams=max_num_tree_beams,is_log_prob=True)
+                for query_log_probs in torch.split(next_restricted_log_probs.view(-1), query_sizes)
+            ]).view(-1, vocab_size)
+        elif isinstance(num_beams, int):
+            next_restricted_log_probs = _filter_query_beams(
+                next_restricted_log_probs, active_inds, num_active,
+                lambda rows, qids: top_k_top_p_filtering(rows, top_k=num_beams, is_log_prob=True))
+        else:  # float coverage, shared or per query
+            # Queries may be at different steps (and coverages), so each gets its own top_p
+            active_coverage = (num_beams[active_qids] if isinstance(num_beams, torch.Tensor)
+                               else torch.full((num_active,), num_beams, dtype=torch.float64, device=device))
+            active_top_p = interp_func(active_coverage, query_t[active_qids].double(), seq_len)
+            next_restricted_log_probs = _filter_query_beams(
+                next_restricted_log_probs, active_inds, num_active,
+                lambda rows, qids: top_k_top_p_filtering(rows, top_p=active_top_p[qids], is_log_prob=True,
+                                                   top_p_candidates=top_p_candidates))
+
+        next_log_probs = next_log_probs.masked_fill(next_restricted_log_probs == -float('inf'), -float('inf')).view(-1)
+        next_restricted_log_probs = next_restricted_log_probs.view(-1)
+
+        # Keep the surviving candidates, still grouped by query
+        indices = torch.nonzero(next_log_probs != -float('inf')).squeeze(-1)
+        seq_inds = torch.div(indices, vocab_size, rounding_mode='trunc')
+        beams = (indices % vocab_size).to(token_dtype).unsqueeze(-1)
+        beam_qids = beam_qids.index_select(0, seq_inds)
+        cur_log_probs = next_log_probs.index_select(0, indices)
+        cur_restricted_log_probs = next_restricted_log_probs.index_select(0, indices)
+        rnn_args = _select_states(states, seq_inds)
+
+        query_t[active_qids] += 1
+        num_beams_over_time.index_put_((beam_qids, query_t[beam_qids] - 1),
+                                       torch.ones_like(beam_qids), accumulate=True)
+
+    num_beams_over_time = num_beams_over_time.cpu()
+    return {
+        "tree": None,
+        "bs_lower_bound": bs_lower_bound.cpu(),  # (queries, vocab)
+        "true_coverage": true_coverage.cpu(),  # (queries,)
+        "restricted_coverage": restricted_coverage.cpu(),
+        "num_beams": num_beams_over_time,  # (queries, seq_len)
+        "num_beams_over_time": num_beams_over_time,
+        "model_iters": num_beams_over_time.sum(dim=-1),
+        "intermediate_lbs": intermediate_lbs.cpu() if store_intermediate_lbs else torch.Tensor([]),  # (queries, seq_len+1, vocab)
+    }
+
+
 #######################################################################
 # Hybrid no replacement
 #######################################################################
@@ -722,6 +992,7 @@ def tree_is_estimate_nr(
     sub_estimates=None,
     **kwargs,
  ):
+    excluded_inds = torch.LongTensor(excluded_terms)  # built once, reused every step
     # Sample each sequence individually from tree
     log_p_totals, log_q_totals = [], []
     hidden_states, num_remaining_steps = [], []
@@ -749,9 +1020,8 @@ def tree_is_estimate_nr(
     # Skip this detail for now
     if sub_estimates:
         model_iters = []
-        samples_per_effort = [
-            (num_remaining_steps == i).sum().item() for i in range(num_remaining_steps.max()+1)
-        ];
+        # Number of samples needing each count of remaining steps, counted in one pass
+        samples_per_effort = torch.bincount(num_remaining_steps).tolist()
         j = 0
         for i in range(len(sub_estimates)):
             total_samp = 0; total_cost = model.model_iters
@@ -766,43 +1036,10 @@ def tree_is_estimate_nr(
                     model_iters.append(total_cost)
                     break
 
-    while (num_remaining_steps > 0).any():
-        to_update = num_remaining_steps > 0
-        if isinstance(hidden_states, tuple):
-            rnn_args = (hidden_states[0][..., to_update, :], hidden_states[1][..., to_update, :])
-        else:
-            rnn_args = hidden_states[..., to_update, :]
-        logits, rnn_args = model.get_next_probs(
-            last_tokens[to_update, :],
-            rnn_args=rnn_args,
-            max_batch_size=batch_size,
-            device=device,
-            return_logits=True,
-        )
-
-        proposal_logits = logits.clone()
-        proposal_logits[..., excluded_terms] = -float('inf')
-        logits, proposal_logits = torch.log_softmax(logits, dim=-1), torch.log_softmax(proposal_logits, dim=-1)
-        last_sample = torch.distributions.Categorical(logits=proposal_logits).sample().unsqueeze(-1)
-        log_q_totals[to_update] += torch.gather(proposal_logits, dim=-1, index=last_sample).squeeze(-1)
-        log_p_totals[to_update] += torch.gather(logits, dim=-1, index=last_sample).squeeze(-1)
-        if isinstance(hidden_states, tuple):
-            hidden_states[0][..., to_update, :] = rnn_args[0]
-            hidden_states[1][..., to_update, :] = rnn_args[1]
-        else:
-            hidden_states[..., to_update, :] = rnn_args
-        num_remaining_steps[to_update] -= 1
-        last_tokens[to_update, :] = last_sample
-
-    # Compute final distributions for estimate
-    next_log_dist, _ = model.get_next_probs(
-        last_tokens,
-        hidden_states,
-        max_batch_size=batch_size,
-        device=device,
-        return_logits=True,
-    )
-    next_log_dist = torch.log_softmax(next_log_dist, dim=-1)  # (num_seqs, vocab_size)
+    # Sequences are finished together, the batch shrinks as they complete
+    next_log_dist, log_p_totals, log_q_totals = _finish_tree_samples(
+        model, last_tokens, hidden_states, num_remaining_steps,
+        log_p_totals, log_q_totals, excluded_inds, batch_size, device)
     dist_estimate = next_log_dist + log_p_totals.unsqueeze(dim=-1) - log_q_totals.unsqueeze(dim=-1)
     dist_estimate = dist_estimate.exp().cpu()
     dist_est_var = dist_estimate.var(dim=0)
@@ -18,7 +18,7 @@ import torch
 import torch.nn as nn
 from collections import defaultdict
 
-from .utils import top_k_top_p_filtering, _tup_cpu, _hidden_state_select
+from .utils import top_k_top_p_filtering, _tup_cpu, _hidden_state_select, _stack_kv
 
 #################################################################################
 #   Function-Class Declaration
@@ -134,6 +134,10 @@ class BeamSearchSampleTree(object):
             "Parent ids were of shape {} but symbols were of shape {} and q was of shape {} and p was of shape {} and h_state was of shape {}"\
             .format(parent_ids.shape,symbols.shape, log_q_conditionals.shape, log_p_conditionals.shape,hidden_states[0].shape)
 
+        if self.uses_attention:
+            # Stacked once, so each child is selected with a single slice
+            hidden_states = _stack_kv(hidden_states)
+
         for i in range(symbols.shape[0]):
             s,pid,q,p,h = (symbols[i],parent_ids[i],log_q_conditionals[i],
                             log_p_conditionals[i],_hidden_state_select(hidden_states,i,
@@ -229,8 +233,9 @@ class BeamSearchSampleTree(object):
             next_step = torch.distributions.Categorical(probs=cur_node.q_conditionals).sample()
             sample.append(next_step.item())
             if self.uses_attention: attns.append(cur_node.hidden_state)
-            log_p_total += cur_node.p_conditionals.log()[next_step]
-            log_q_total += cur_node.q_conditionals.log()[next_step]
+            # Only the sampled term is needed, take its log after the lookup
+            log_p_total += cur_node.p_conditionals[next_step].log()
+            log_q_total += cur_node.q_conditionals[next_step].log()
             depth += 1
             if next_step.item() in cur_node.children:
                 cur_node = cur_node.children[next_step.item()]
@@ -1,3 +1,6 @@
+import io
+import os
+import copy
 import torch
 import time
 import torch.nn as nn
@@ -8,18 +11,42 @@ import yaml
 import pickle as pkl
 import json
 import ast
+import functools
+import itertools
 
 from datetime import datetime
+from collections import namedtuple
 import torch.nn.functional as F
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
 #######################################################################
 # Data
 #######################################################################
 
+# Keys and values of all layers stacked, each (layers, samples, num_heads, seq_len, dim)
+KVCache = namedtuple('KVCache', ['k', 'v'])
+
+def _stack_kv(state):
+    """Stacks per-layer (key, value) pairs into a KVCache."""
+    keys, values = zip(*state)
+    return KVCache(torch.stack(keys), torch.stack(values))
+
 def _hidden_state_select(state,i,
                          is_root = False,
                          uses_attention=False):
-    if uses_attention:
+    if uses_attention and isinstance(state, KVCache):
+        # One slice for every layer, then unbound into the (layers, (2)) views
+        k, v = state.k[:, i:i+1], state.v[:, i:i+1]
+        if not is_root:
+            k, v = k[...,-1:,:], v[...,-1:,:]
+        state = tuple(zip(k.unbind(0), v.unbind(0)))
+    elif uses_attention:
         state = tuple(
             # (layers, (2, (samples, num_heads, seq_len, dim)))
             [(h1[i].unsqueeze(0), h2[i].unsqueeze(0))
@@ -36,11 +63,15 @@ def _hidden_state_select(state,i,
             state = state[...,i,:]
     return state
 
+def _cpu_copies(tensors):
+    # Copies land in pageable host memory, each waits only on its own stream
+    return [t.to('cpu') for t in tensors]
+
 def _tup_cpu(tup, force=False):
     if isinstance(tup,tuple) and isinstance(tup[0],tuple):
         return _tup_cpu_gpt2(tup)
     elif force or isinstance(tup, tuple):
-        return tuple([t.cpu() for t in tup])
+        return tuple(_cpu_copies(tup))
     elif tup: return tup.cpu()
     else: return tup
 
@@ -48,13 +79,15 @@ def _tup_cpu(tup, force=False):
 def _tup_cpu_gpt2(tup, force=False):
     if not tup: return tup
     elif force or isinstance(tup, tuple):
-        return tuple([(t1.cpu(),t2.cpu()) for (t1,t2) in tup])
+        copies = _cpu_copies([t for pair in tup for t in pair])
+        return tuple(zip(copies[::2], copies[1::2]))
     else: return tup.cpu()
 
 def _tup_gpu_gpt2(tup, device,force=False):
     if not tup: return tup
     elif force or isinstance(tup, tuple):
-        return tuple([(t1.to(device),t2.to(device)) for (t1,t2) in tup])
+        return tuple([(t1.to(device, non_blocking=True),t2.to(device, non_blocking=True))
+                      for (t1,t2) in tup])
     else: return tup.to(device)
 
 def _tup_gpu(tup, device,force=False):
@@ -62,30 +95,69 @@ def _tup_gpu(tup, device,force=False):
         return _tup_gpu_gpt2(tup,device)
     if not tup: return tup
     if force or isinstance(tup, tuple):
-        return tuple([t.to(device) for t in tup])
-    return tup.to(device)
+        return tuple([t.to(device, non_blocking=True) for t in tup])
+    return tup.to(device, non_blocking=True)
+
+AMP_DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+def _autocast(device, amp_dtype=None):
+    """Autocast context for inference forward passes. Disabled if `amp_dtype` is None."""
+    return torch.autocast(torch.device(device).type, dtype=AMP_DTYPES.get(amp_dtype),
+                          enabled=amp_dtype is not None)
 
 def read_yaml(filename):
     if filename is None: return None
+    # Parsed once per file version, callers get their own copy to modify
+    return copy.deepcopy(_read_yaml_cached(filename, os.path.getmtime(filename)))
+
+@functools.lru_cache(maxsize=32)
+def _read_yaml_cached(filename, mtime):
     with open(filename,'r') as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 def write_yaml(data,filename):
     with open(filename,'w') as file:
         return yaml.dump(data,file)
 
+def _has_tensors(data):
+    if isinstance(data, torch.Tensor): return True
+    if isinstance(data, dict): return any(_has_tensors(v) for v in data.values())
+    if isinstance(data, (list, tuple)): return any(_has_tensors(v) for v in data)
+    return False
+
 def write_pkl(data,name):
+    """Pickles data. If it holds tensors, uses torch's serializer instead
+    (zstd compressed when zstandard is installed). `read_pkl` reads all formats."""
+    if not _has_tensors(data):
+        with open(f'{name}','wb') as file:
+            pkl.dump(data,file,protocol=pkl.HIGHEST_PROTOCOL)
+        return
+
+    buffer = io.BytesIO()
+    torch.save(data,buffer)
+    data = buffer.getvalue()
+    if zstandard is not None:
+        data = zstandard.ZstdCompressor(level=3).compress(data)
     with open(f'{name}','wb') as file:
-        data = pkl.dump(data,file)
+        file.write(data)
 
 def read_pkl(name):
     with open(f'{name}','rb') as file:
-        data = pkl.load(file)
-    return data
+        data = file.read()
+    if data[:4] == ZSTD_MAGIC:
+        assert zstandard is not None, f"zstandard is needed to read compressed file {name}"
+        data = zstandard.ZstdDecompressor().decompress(data)
+    if data[:2] == b'PK':  # torch zip serialization
+        return torch.load(io.BytesIO(data),map_location='cpu',weights_only=False)
+    return pkl.loads(data)
 
 
 def read_json(filepath):
-    return json.load(open(filepath,'r'))
+    with open(filepath,'r') as file:
+        return json.load(file)
 
 def write_json(data,filepath):
     with open(filepath,'w') as file:
@@ -97,8 +169,9 @@ def write_json(data,filepath):
 #######################################################################
 
 def accuracy_score(gt, logits):
-    preds = torch.argmax(F.softmax(logits,dim=-1),dim=-1).flatten()
-    return ((preds == gt).sum()/preds.shape[0])*100
+    # Softmax is monotonic, the argmax of the logits is the same prediction
+    preds = torch.argmax(logits,dim=-1).flatten()
+    return (preds == gt).float().mean()*100
 
 
 #######################################################################
@@ -128,7 +201,8 @@ class GELU(nn.Module):
         super().__init__()
 
     def forward(self, x):
-        return 0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
+        # Same tanh approximation as before, in ATen's single fused kernel
+        return F.gelu(x, approximate='tanh')
 
 
 ACTIVATIONS = {
@@ -146,8 +220,8 @@ def print_log(*args):
     """Custom print function that records time of function call."""
     print("[{}]".format(datetime.now()), *args)
 
-def truncated_normal(size, scale=1, limit=2):
-    """Samples a tensor from an approximately truncated normal tensor.
+def truncated_normal(size, scale=1, limit=2, device=None):
+    """Samples a tensor from a truncated normal tensor.
 
     Arguments:
         size {tuple of ints} -- Size of desired tensor
@@ -155,13 +229,15 @@ def truncated_normal(size, scale=1, limit=2):
     Keyword Arguments:
         scale {int} -- Standard deviation of normal distribution (default: {1})
         limit {int} -- Number of standard deviations to truncate at (default: {2})
+        device {torch.device} -- Device the sample is created on (default: {None})
 
     Returns:
         torch.FloatTensor -- A truncated normal sample of requested size
     """
-    return torch.fmod(torch.randn(size),limit) * scale
+    return nn.init.trunc_normal_(torch.empty(size, device=device),
+                                 mean=0.0, std=scale, a=-limit*scale, b=limit*scale)
 
-def xavier_truncated_normal(size, limit=2, no_average=False):
+def xavier_truncated_normal(size, limit=2, no_average=False, device=None):
     """Samples from a truncated normal where the standard deviation is automatically chosen based on size."""
     if isinstance(size, int):
         size = (size,)
@@ -172,11 +248,11 @@ def xavier_truncated_normal(size, limit=2, no_average=False):
         n_in, n_out = size[-2], size[-1]
         n_avg = (n_in + n_out) / 2
 
-    return truncated_normal(size, scale=(1/n_avg)**0.5, limit=2)
+    return truncated_normal(size, scale=(1/n_avg)**0.5, limit=2, device=device)
 
 def flatten(list_of_lists):
     """Turn a list of lists (or any iterable) into a flattened list."""
-    return [item for sublist in list_of_lists for item in sublist]
+    return list(itertools.chain.from_iterable(list_of_lists))
 
 #######################################################################
 # Top k top p and minimum variance reduction
@@ -188,25 +264,30 @@ def min_variance_top_k(logits, min_var_reduction = 0.0,
                        max_num_tree_beams=None):
     num_logits = logits.shape[0]
     probs, prob_inds = torch.sort(logits.exp(), descending=True)
-    global_var = probs.var()
-    local_vars = torch.Tensor([
-        (probs[:i].var(unbiased=False) + probs[i:].var(unbiased=False))
-        for i in range(1,min(num_logits,max_num_tree_beams)-1,1)
-    ])
+    # Population variance (unbiased=False, a single-element head has variance 0 rather than NaN)
+    # of the head probs[:i] plus the tail probs[i:] for every split i,
+    # from running sums (double precision, as E[x^2] - E[x]^2 cancels)
+    num_splits = min(num_logits,max_num_tree_beams or num_logits)-2
+    sums, sq_sums = probs.double().cumsum(0), probs.double().square().cumsum(0)
+    head_n = torch.arange(1, num_splits+1, dtype=torch.float64, device=probs.device)
+    head_sum, head_sq_sum = sums[:num_splits], sq_sums[:num_splits]
+    tail_n = num_logits - head_n
+    tail_sum, tail_sq_sum = sums[-1] - head_sum, sq_sums[-1] - head_sq_sum
+    local_vars = ((head_sq_sum/head_n - (head_sum/head_n).square()).clamp(min=0) +
+                  (tail_sq_sum/tail_n - (tail_sum/tail_n).square()).clamp(min=0))
 
     min_idx = torch.argmin(local_vars)
-    min_sep_var = local_vars[min_idx]
-
-    # Satisfies variance criteria
-    if not max_num_tree_beams: max_num_tree_beams=min_idx
-    indices_to_remove = prob_inds[min(max_num_tree_beams,min_idx)+1:]
-    logits[indices_to_remove] = filter_value
 
-    return logits
+    # Satisfies variance criteria, the cutoff stays on device (no sync on min_idx)
+    cutoff = min_idx.clamp(max=max_num_tree_beams) if max_num_tree_beams else min_idx
+    sorted_remove = torch.arange(num_logits, device=logits.device) > cutoff
+    indices_to_remove = torch.empty_like(sorted_remove).scatter_(0, prob_inds, sorted_remove)
+    return logits.masked_fill(indices_to_remove, filter_value)
 
 
 
-def top_k_top_p_filtering(logits, top_k=0, top_p=0.0,min_var=False, filter_value=-float('Inf'), is_log_prob=False):
+def top_k_top_p_filtering(logits, top_k=0, top_p=0.0,min_var=False, filter_value=-float('Inf'), is_log_prob=False,
+                          top_p_candidates=None):
     """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering.
         Currently only supports a batch size of 1.
         Adapted from https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
@@ -215,29 +296,54 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0,min_var=False, filter_value
             top_k >0: keep only top k tokens with highest probability (top-k filtering).
             top_p >0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
                 Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+                top_p >= 1.0 keeps every token. May also be a tensor with one top_p per row, rows
+                with top_p <= 0 or >= 1 are not filtered.
+            top_p_candidates: if set, only the top candidates are sorted (topk) when they already
+                reach top_p in every row, the whole row is sorted otherwise.
     """
     #logits = logits.squeeze()
     #assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-    top_k = min(top_k, logits.size(-1))  # Safety check
+    # top_k covering the vocab and top_p of 1 keep every token, skipped
+    num_logits = logits.size(-1)
+    if top_k >= num_logits: top_k = 0
+    if not isinstance(top_p, torch.Tensor) and top_p >= 1.0: top_p = 0.0
     if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits = logits.masked_fill(indices_to_remove, filter_value)
-
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        if is_log_prob:
-            cumulative_probs = sorted_logits.exp().cumsum(dim=-1)
-        else:
-            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1) #torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove) #sorted_indices[sorted_indices_to_remove]
+        # Remove all tokens with a probability less than the last token of the top-k,
+        # only that threshold is needed so it is selected directly (k-th largest)
+        kth_logit = torch.kthvalue(logits, num_logits - top_k + 1, dim=-1, keepdim=True).values
+        logits = logits.masked_fill(logits < kth_logit, filter_value)
+
+    if isinstance(top_p, torch.Tensor) or top_p > 0.0:
+        if isinstance(top_p, torch.Tensor):
+            # Thresholds past every cumulative probability keep the whole row
+            top_p = torch.where((top_p > 0) & (top_p < 1), top_p, torch.full_like(top_p, float('inf')))
+            top_p = top_p.to(logits.dtype).unsqueeze(-1)
+        else: top_p = logits.new_full(logits.shape[:-1] + (1,), top_p)
+        # Probabilities are taken from the sorted logits, a single exp pass. Sorting stays
+        # on the logits, where underflowed probabilities keep their order
+        sorted_logits = None
+        if top_p_candidates and top_p_candidates < num_logits:
+            sorted_logits, sorted_indices = torch.topk(logits, top_p_candidates)
+            # A partial row needs the normalizer of the full row
+            log_norm = 0.0 if is_log_prob else torch.logsumexp(logits, dim=-1, keepdim=True)
+            cumulative_probs = (sorted_logits - log_norm).exp().cumsum(dim=-1)
+            if not (cumulative_probs[..., -1:] > top_p).all():
+                sorted_logits = None  # Some row needs more than the top candidates
+        if sorted_logits is None:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative_probs = (sorted_logits.exp() if is_log_prob
+                                else sorted_logits.softmax(dim=-1)).cumsum(dim=-1)
+
+        # Keep tokens up to and including the first one that takes the cumulative
+        # probability above the threshold (cumulative probabilities are sorted).
+        # Removal is by sorted position, so of tokens tied at the cutoff only those
+        # sorted before it are kept
+        num_keep = torch.searchsorted(cumulative_probs, top_p, right=True) + 1
+        positions = torch.arange(sorted_logits.size(-1), device=logits.device)
+        sorted_indices_to_remove = positions >= num_keep
+        # Tokens outside the top candidates are removed as well
+        indices_to_remove = torch.ones_like(logits, dtype=torch.bool).scatter_(
+            -1, sorted_indices, sorted_indices_to_remove)
         logits = logits.masked_fill(indices_to_remove, filter_value)
 
     return logits  #.unsqueeze(0).unsqueeze(0)
@@ -255,24 +361,27 @@ def compute_num_beams_from_budget(vocab_size, beam, seq_len, excluded_terms):
 
     """
     num_excl = len(excluded_terms)
-    vocab_size -= num_excl # Restricted vocab
+    # Restricted vocab, only its size matters so budgets repeated across queries are cached
+    return _num_beams_from_budget(vocab_size - num_excl, beam, seq_len)
+
+@functools.lru_cache(maxsize=None)
+def _num_beams_from_budget(vocab_size, beam, seq_len):
     if beam <= vocab_size:
         return beam
 
+    # Python ints, vocab_size**seq_len overflows int64
     extra = 0
-    final_beams = []
+    curr_vocab = 1
     for i in range(seq_len):
-        curr_vocab = vocab_size**(i+1)
+        curr_vocab *= vocab_size
         if beam < curr_vocab and extra == 0:
-            return beam[-1]
+            return beam
 
         extra_piece = extra//(seq_len - i)
         leftover = max((beam + extra_piece) - curr_vocab,0)
         new_beam = min(extra_piece + beam, curr_vocab)
         extra -= (extra_piece - leftover)
-
-        final_beams.append(new_beam)
-    return final_beams[-1]
+    return new_beam
 
 def _set_random_seed(seed):
     """Set random seed for reproducibility."""